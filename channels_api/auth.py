@@ -0,0 +1,191 @@
+import functools
+from importlib import import_module
+
+from channels.auth import channel_session_user
+from channels.sessions import enforce_ordering, session_for_reply_channel
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save
+from django.utils.functional import SimpleLazyObject, empty
+
+from .settings import api_settings
+
+
+def cache_is_shared():
+    """Whether the default cache is shared between processes."""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def _require_shared_cache():
+    # a logout handled by another process must reach the websocket workers
+    if not cache_is_shared():
+        raise ImproperlyConfigured(
+            'Caching users needs a default cache that is shared between processes, '
+            'e.g. memcached, redis or the database cache.'
+        )
+
+
+def _user_key(reply_channel):
+    return 'channels_api:user:{}'.format(reply_channel)
+
+
+def _version_key(user_pk):
+    return 'channels_api:user_version:{}'.format(user_pk)
+
+
+def _get_cached_entry(reply_channel):
+    entry = cache.get(_user_key(reply_channel))
+    if entry is None:
+        return None
+    user, version, http_session_key = entry
+    if cache.get(_version_key(user.pk), 0) != version:
+        return None
+    return user, http_session_key
+
+
+def get_cached_user(reply_channel):
+    """
+    Returns the user cached for a connection, or None if there is none or it
+    has been invalidated.
+    """
+    entry = _get_cached_entry(reply_channel)
+    return entry[0] if entry is not None else None
+
+
+def set_cached_user(reply_channel, user, http_session_key=None):
+    version = cache.get(_version_key(user.pk), 0)
+    cache.set(_user_key(reply_channel), (user, version, http_session_key), api_settings.USER_CACHE_TIMEOUT)
+
+
+def invalidate_cached_user(user):
+    """
+    Drops the cached user from every connection, e.g. after its permissions
+    have changed. The user is loaded again on the next message.
+    """
+    key = _version_key(user.pk)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+
+def _remember_user(message):
+    # anonymous users are not cached so logins are picked up
+    if getattr(message, 'from_user_cache', False) or not message.user.pk:
+        return
+    http_session = getattr(message, 'http_session', None)
+    http_session_key = http_session.session_key if http_session is not None else None
+    set_cached_user(message.reply_channel.name, message.user, http_session_key)
+
+
+def _call_with_cached_user(func, entry, message, *args, **kwargs):
+    """
+    Runs func with the cached user. The sessions are only loaded if func
+    touches them, and saved afterwards if it changed them.
+    """
+    user, http_session_key = entry
+    message.user = user
+    message.from_user_cache = True
+    reply_channel = message.reply_channel.name
+    # sessions set up by outer decorators (e.g. enforce_ordering) are saved by them
+    channel_session = http_session = None
+    if not hasattr(message, 'channel_session'):
+        channel_session = SimpleLazyObject(lambda: session_for_reply_channel(reply_channel))
+        message.channel_session = channel_session
+    if not hasattr(message, 'http_session'):
+        if http_session_key:
+            session_engine = import_module(settings.SESSION_ENGINE)
+            http_session = session_engine.SessionStore(session_key=http_session_key)
+        message.http_session = http_session
+    try:
+        return func(message, *args, **kwargs)
+    finally:
+        if channel_session is not None and channel_session._wrapped is not empty:
+            if channel_session.modified and not channel_session.is_empty():
+                channel_session.save()
+        if http_session is not None and http_session.modified:
+            http_session.save()
+
+
+def channel_session_cached_user(func):
+    """
+    Like channels' channel_session_user, but caches the authenticated user
+    (including any permission caches on it) for the connection, so steady-state
+    messages do not load the session or the user. On those messages
+    channel_session is loaded when it is first used.
+    """
+    _require_shared_cache()
+
+    @channel_session_user
+    def resolve(message, *args, **kwargs):
+        _remember_user(message)
+        return func(message, *args, **kwargs)
+
+    @functools.wraps(func)
+    def inner(message, *args, **kwargs):
+        if getattr(message, 'from_user_cache', False):
+            return func(message, *args, **kwargs)
+        entry = _get_cached_entry(message.reply_channel.name)
+        if entry is not None:
+            return _call_with_cached_user(func, entry, message, *args, **kwargs)
+        return resolve(message, *args, **kwargs)
+    return inner
+
+
+class CachedUserMixin(object):
+    """
+    Caches the user of a websocket consumer with http_user or
+    http_user_and_session (e.g. a WebsocketDemultiplexer) for the connection.
+
+    The user is resolved from the sessions on connect and whenever it is not
+    cached; other frames take it from the cache, so together with
+    cache_user = True on the bindings they run no session or user queries.
+    The sessions are still available, but only loaded when they are used.
+    """
+
+    def get_handler(self, message, **kwargs):
+        _require_shared_cache()
+        if message.channel.name == 'websocket.receive':
+            entry = _get_cached_entry(message.reply_channel.name)
+            if entry is not None:
+                self.path = message['path']
+                receive = getattr(self, self.method_mapping[message.channel.name])
+
+                def handler(message, **kwargs):
+                    return _call_with_cached_user(receive, entry, message, **kwargs)
+                if self.strict_ordering:
+                    return enforce_ordering(handler, slight=False)
+                return handler
+        return super(CachedUserMixin, self).get_handler(message, **kwargs)
+
+    def raw_connect(self, message, **kwargs):
+        _remember_user(message)
+        super(CachedUserMixin, self).raw_connect(message, **kwargs)
+
+    def raw_receive(self, message, **kwargs):
+        _remember_user(message)
+        super(CachedUserMixin, self).raw_receive(message, **kwargs)
+
+    def raw_disconnect(self, message, **kwargs):
+        cache.delete(_user_key(message.reply_channel.name))
+        super(CachedUserMixin, self).raw_disconnect(message, **kwargs)
+
+
+def logout_receiver(sender, user=None, **kwargs):
+    if user is not None and user.pk:
+        invalidate_cached_user(user)
+
+
+def user_saved_receiver(sender, instance=None, update_fields=None, **kwargs):
+    # e.g. a password change or deactivation; logging in only updates last_login
+    model = '{}.{}'.format(sender._meta.app_label, sender._meta.object_name)
+    if model.lower() != settings.AUTH_USER_MODEL.lower():
+        return
+    if update_fields is not None and set(update_fields) == set(['last_login']):
+        return
+    invalidate_cached_user(instance)
+
+
+user_logged_out.connect(logout_receiver)
+post_save.connect(user_saved_receiver)
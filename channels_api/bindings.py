@@ -1,17 +1,36 @@
+import hashlib
 import json
 
+from channels import Channel
 from channels.binding import websockets
 from channels.binding.base import CREATE, UPDATE, DELETE, BindingMetaclass
+from channels.sessions import enforce_ordering
+from django.core.cache import cache
+from django.core.exceptions import FieldError, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.http import Http404
 from django.utils import six
 
-from rest_framework.exceptions import APIException, NotFound
-from rest_framework.generics import get_object_or_404
-
+from .auth import channel_session_cached_user
+from .changelog import get_change_log
+from .compression import compress_message, compression_available, compression_enabled, join_group, \
+    send_to_groups
 from .mixins import SerializerMixin, SubscribeModelMixin, CreateModelMixin, UpdateModelMixin, \
-    PatchModelMixin, RetrieveModelMixin, ListModelMixin, DeleteModelMixin
+    PatchModelMixin, RetrieveModelMixin, ListModelMixin, DeleteModelMixin, AggregateModelMixin, \
+    ListSubscribeModelMixin, CompressionMixin
 from .settings import api_settings
 
+# short action codes used by the 'hashed' group name style
+GROUP_ACTION_CODES = {
+    CREATE: 'c',
+    UPDATE: 'u',
+    DELETE: 'd',
+}
+# channel layers reject group names of 100 characters or more, this leaves
+# room for the suffix of compressed groups
+MAX_GROUP_NAME_LENGTH = 97
+
 
 class ResourceBindingMetaclass(BindingMetaclass):
     """
@@ -43,6 +62,36 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
     serializer_class = None
     lookup_field = 'pk'
     permission_classes = ()
+    # 'label' or 'hashed', defaults to the GROUP_NAME_STYLE setting
+    group_name_style = None
+    # minimum seconds between UPDATE broadcasts of one object, None to disable
+    broadcast_interval = None
+    # serialize and send changes from the broadcast channel instead of the saving thread
+    background_broadcasts = False
+    # record broadcasts with sequence numbers so subscribers can resume
+    change_log = False
+    # send version tokens with retrieve/list replies and honour if_none_match
+    use_etags = False
+    # field that changes with every save (e.g. updated_at), used to build
+    # tokens without serializing
+    version_field = None
+    etag = None
+    # cache the authenticated user per connection instead of loading it for every message
+    cache_user = False
+
+    @classmethod
+    def get_handler(cls):
+        """
+        Adds decorators to trigger_inbound, using the cached user when enabled.
+        """
+        if not cls.cache_user:
+            return super(ResourceBindingBase, cls).get_handler()
+        handler = channel_session_cached_user(cls.trigger_inbound)
+        if cls.strict_ordering:
+            return enforce_ordering(handler, slight=False)
+        elif cls.slight_ordering:
+            return enforce_ordering(handler, slight=True)
+        return handler
 
     def deserialize(self, message):
         body = json.loads(message['text'])
@@ -72,6 +121,17 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
         Triggers the binding to possibly send to its group.
         """
         old_group_names = instance._binding_group_names[cls]
+        # deleted instances cannot be reloaded later, so they are always sent right away
+        if cls.background_broadcasts and action != DELETE:
+            cls.enqueue_change(instance, action, old_group_names)
+        else:
+            cls.send_changes(instance, action, old_group_names, **kwargs)
+
+    @classmethod
+    def send_changes(cls, instance, action, old_group_names, **kwargs):
+        """
+        Sends the change of an instance to the groups it left, stayed in and joined.
+        """
         if action == DELETE:
             new_group_names = set()
         else:
@@ -83,23 +143,201 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
 
         # Django DDP had used the ordering of DELETE, UPDATE then CREATE for good reasons.
         self.send_messages(instance, old_group_names - new_group_names, DELETE, **kwargs)
-        self.send_messages(instance, old_group_names & new_group_names, UPDATE, **kwargs)
+        if cls.broadcast_interval and old_group_names & new_group_names:
+            cls.schedule_update(instance)
+        else:
+            self.send_messages(instance, old_group_names & new_group_names, UPDATE, **kwargs)
         self.send_messages(instance, new_group_names - old_group_names, CREATE, **kwargs)
 
     @classmethod
-    def group_names(cls, instance, action):
+    def enqueue_change(cls, instance, action, old_group_names):
+        """
+        Sends a compact change event to the broadcast channel once the current
+        transaction commits; the broadcast consumer serializes and sends it.
+        """
+        content = {
+            'type': 'change',
+            'binding': cls.binding_key(),
+            'action': action,
+            'pk': six.text_type(instance.pk),
+            'old_group_names': list(old_group_names),
+        }
+
+        def enqueue():
+            Channel(api_settings.BROADCAST_CHANNEL).send(content)
+
+        # Django < 1.9 has no on_commit
+        on_commit = getattr(transaction, 'on_commit', None)
+        if on_commit is not None:
+            on_commit(enqueue)
+        else:
+            enqueue()
+
+    @classmethod
+    def send_queued_change(cls, action, pk, old_group_names):
+        """
+        Sends a change event from `enqueue_change` with the current state of the object.
+        """
+        instance = cls.model._default_manager.filter(pk=pk).first()
+        if instance is None:
+            return  # deleted in the meantime, the DELETE is sent on its own
+        cls.send_changes(instance, action, set(old_group_names))
+
+    def send_messages(self, instance, group_names, action, **kwargs):
+        """
+        Serializes the instance and sends it to all provided group names.
+        """
+        if not group_names:
+            return  # no need to serialize, bail.
+        self.signal_kwargs = kwargs
+        payload = self.serialize(instance, action)
+        if payload == {}:
+            return  # nothing to send, bail.
+
+        if self.change_log:
+            # the log stores its own copy stamped with the same seq
+            payload['seq'] = self.get_change_log().append(self.binding_key(), group_names, payload)
+
+        assert self.stream is not None
+        self.send_to_groups(group_names, self.encode(self.stream, payload))
+
+    @classmethod
+    def send_to_groups(cls, group_names, message):
+        """
+        Sends an encoded message to groups, and a compressed copy to the
+        compressed variants of groups that have compressed members.
+        """
+        send_to_groups(group_names, message)
+
+    def join_group(self, group_name):
+        """
+        Adds the reply channel to a group, or to its compressed variant if the
+        connection has enabled compression.
+        """
+        join_group(group_name, self.message.reply_channel)
+
+    def get_change_log(self):
+        return get_change_log()
+
+    def get_changes_since(self, group_name, seq):
+        """
+        Returns the payloads sent to `group_name` after `seq`, or None if the
+        change log no longer holds all of them.
+        """
+        entries = self.get_change_log().since(self.binding_key(), seq)
+        if entries is None:
+            return None
+        return [entry['payload'] for entry in entries if group_name in entry['groups']]
+
+    @classmethod
+    def schedule_update(cls, instance):
+        """
+        Defers the UPDATE broadcast of an instance by `broadcast_interval` seconds.
+
+        Only one broadcast is pending per object at a time; it reloads the
+        instance when it fires so subscribers get the latest state.
+        """
+        key = cls._pending_update_key(instance.pk)
+        # the timeout only matters if the delay server drops the message
+        if not cache.add(key, True, cls.broadcast_interval * 2 + 1):
+            return
+        Channel('asgi.delay').send({
+            'channel': api_settings.BROADCAST_CHANNEL,
+            'delay': int(cls.broadcast_interval * 1000),
+            'content': {
+                'type': 'pending_update',
+                'binding': cls.binding_key(),
+                'action': UPDATE,
+                'pk': six.text_type(instance.pk),
+            }
+        })
+
+    @classmethod
+    def send_pending_update(cls, pk):
+        """
+        Sends a deferred UPDATE broadcast with the current state of the object.
+        """
+        cache.delete(cls._pending_update_key(pk))
+        instance = cls.model._default_manager.filter(pk=pk).first()
+        if instance is None:
+            return  # deleted in the meantime, the DELETE was not deferred
         self = cls()
-        groups = [self._group_name(action)]
+        self.instance = instance
+        self.send_messages(instance, set(cls.group_names(instance, UPDATE)), UPDATE)
+
+    @classmethod
+    def _pending_update_key(cls, pk):
+        return 'channels_api:pending:{}:{}'.format(cls.binding_key(), pk)
+
+    @classmethod
+    def binding_key(cls):
+        """Identifies the binding class in messages sent to the broadcast channel."""
+        return '{}.{}'.format(cls.__module__, cls.__name__)
+
+    @classmethod
+    def from_binding_key(cls, key):
+        """Looks up a registered binding class by its `binding_key`."""
+        for binding in BindingMetaclass.binding_classes:
+            if issubclass(binding, ResourceBindingBase) and binding.binding_key() == key:
+                return binding
+        raise LookupError("No binding registered for %r" % key)
+
+    @classmethod
+    def group_names(cls, instance, action):
+        groups = [cls._group_name(action)]
         if instance.pk:
-            groups.append(self._group_name(action, id=instance.pk))
+            groups.append(cls._group_name(action, id=instance.pk))
         return groups
 
-    def _group_name(self, action, id=None):
+    @classmethod
+    def detail_group_names(cls, action, pks):
+        """Returns the per-object group names of `action` for many pks at once."""
+        key = cls._group_key(action)
+        return [cls._join_group_name(key, pk) for pk in pks]
+
+    @classmethod
+    def _group_key(cls, action):
+        """
+        Returns the precomputed group name prefix for an action.
+
+        Keys are built once per binding class, the first time they are needed
+        after the model label has been resolved.
+        """
+        style = cls.group_name_style or api_settings.GROUP_NAME_STYLE
+        cache = cls.__dict__.get('_group_keys')
+        if cache is None:
+            cache = {}
+            cls._group_keys = cache
+        keys = cache.setdefault(style, {})
+        try:
+            return keys[action]
+        except KeyError:
+            pass
+        if style == 'hashed':
+            label = hashlib.sha1(cls.model_label.encode('utf-8')).hexdigest()[:10]
+            key = "{}.{}".format(label, GROUP_ACTION_CODES.get(action, action))
+        elif style == 'label':
+            key = "{}-{}".format(cls.model_label, action)
+        else:
+            raise ValueError("Unknown group name style %r on %r" % (style, cls))
+        keys[action] = key
+        return key
+
+    @classmethod
+    def _group_name(cls, action, id=None):
         """Formatting helper for group names."""
         if id:
-            return "{}-{}-{}".format(self.model_label, action, id)
+            return cls._join_group_name(cls._group_key(action), id)
         else:
-            return "{}-{}".format(self.model_label, action)
+            return cls._group_key(action)
+
+    @staticmethod
+    def _join_group_name(key, id):
+        name = "{}-{}".format(key, id)
+        if len(name) > MAX_GROUP_NAME_LENGTH:
+            # keep long pks (e.g. slugs) within the channel layer limit
+            name = "{}-{}".format(key, hashlib.sha1(six.text_type(id).encode('utf-8')).hexdigest())
+        return name
 
     def has_permission(self, user, action, pk):
         if self.permission_classes:
@@ -124,6 +362,9 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
             return [errors]
 
     def get_object_or_404(self, pk):
+        # Late imports to keep rest_framework out of the import path
+        from rest_framework.exceptions import NotFound
+        from rest_framework.generics import get_object_or_404
         queryset = self.filter_queryset(self.get_queryset())
         filter_kwargs = {self.lookup_field: pk}
         try:
@@ -132,6 +373,45 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
             # transform Http404 into an APIException
             raise NotFound
 
+    def check_etag(self, data, etag):
+        """
+        Records the etag for the reply and returns True if the client sent it
+        as `if_none_match`, i.e. already has this version.
+        """
+        self.etag = etag
+        return bool(data) and data.get('if_none_match') == etag
+
+    def get_data_etag(self, data):
+        encoded = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+    def get_version_etag(self, queryset):
+        """
+        Builds an etag from the pks and `version_field` of a queryset without
+        loading full rows. Returns None if the queryset is empty or invalid.
+        """
+        try:
+            versions = list(queryset.values_list('pk', self.version_field))
+        except (TypeError, ValueError, ValidationError, FieldError):
+            return None
+        if not versions:
+            return None
+        return self.get_data_etag(versions)
+
+    def get_object_version_etag(self, pk):
+        """
+        Returns the version etag of the object with the given pk, or None if
+        it does not exist. Raises NotFound for malformed pks like
+        get_object_or_404.
+        """
+        from rest_framework.exceptions import NotFound
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            queryset = queryset.filter(**{self.lookup_field: pk})
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound
+        return self.get_version_etag(queryset)
+
     def get_queryset(self):
         assert self.queryset is not None, (
             "'%s' should either include a `queryset` attribute, "
@@ -141,6 +421,7 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
         return self.queryset.all()
 
     def run_action(self, action, pk, data):
+        from rest_framework.exceptions import APIException
         try:
             if not self.has_permission(self.user, action, pk):
                 self.reply(action, errors=['Permission Denied'], status=401,
@@ -172,18 +453,26 @@ class ResourceBindingBase(SerializerMixin, websockets.WebsocketBinding):
             'response_status': status,
             'request_id': request_id
         }
-        return self.message.reply_channel.send(self.encode(self.stream, payload))
+        if self.etag is not None:
+            payload['etag'] = self.etag
+        message = self.encode(self.stream, payload)
+        reply_channel = self.message.reply_channel
+        if compression_available() and len(message['text']) > api_settings.COMPRESSION_THRESHOLD \
+                and compression_enabled(reply_channel.name):
+            message = compress_message(message)
+        return reply_channel.send(message)
 
 
-class ResourceBinding(CreateModelMixin, RetrieveModelMixin, ListModelMixin,
-    UpdateModelMixin, PatchModelMixin, DeleteModelMixin, SubscribeModelMixin, ResourceBindingBase):
+class ResourceBinding(CreateModelMixin, RetrieveModelMixin, ListModelMixin, AggregateModelMixin,
+    UpdateModelMixin, PatchModelMixin, DeleteModelMixin, SubscribeModelMixin, ListSubscribeModelMixin,
+    CompressionMixin, ResourceBindingBase):
 
     # mark as abstract
     model = None
 
 
-class ReadOnlyResourceBinding(RetrieveModelMixin, ListModelMixin,
-    ResourceBindingBase):
+class ReadOnlyResourceBinding(RetrieveModelMixin, ListModelMixin, AggregateModelMixin,
+    CompressionMixin, ResourceBindingBase):
 
     # mark as abstract
     model = None
@@ -0,0 +1,132 @@
+import threading
+from collections import deque
+
+from django.core.cache import cache
+
+from .settings import api_settings
+
+
+class BaseChangeLog(object):
+    """
+    Bounded log of the messages a binding has broadcast, keyed by binding.
+
+    Every entry gets a sequence number that increases monotonically per binding
+    so reconnecting clients can ask for the changes they missed.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or api_settings.CHANGE_LOG_SIZE
+
+    def append(self, key, groups, payload):
+        """
+        Records a payload sent to `groups` and returns its sequence number.
+        The stored payload is stamped with the number as `seq`.
+        """
+        raise NotImplementedError()
+
+    def last_seq(self, key):
+        """Returns the sequence number of the latest entry, 0 if there is none."""
+        raise NotImplementedError()
+
+    def since(self, key, seq):
+        """
+        Returns the entries recorded after `seq` as dicts with `seq`, `groups`
+        and `payload` keys, or None if some of them have already been discarded
+        or `seq` is ahead of the log (e.g. it was issued by a lost log).
+        """
+        raise NotImplementedError()
+
+
+class MemoryChangeLog(BaseChangeLog):
+    """
+    Change log kept in the memory of the current process.
+
+    Only useful when changes are saved by the process that serves the
+    subscriptions, e.g. in tests.
+    """
+
+    def __init__(self, size=None):
+        super(MemoryChangeLog, self).__init__(size)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._last_seq = {}
+
+    def append(self, key, groups, payload):
+        with self._lock:
+            seq = self._last_seq.get(key, 0) + 1
+            self._last_seq[key] = seq
+            entries = self._entries.setdefault(key, deque(maxlen=self.size))
+            entries.append({'seq': seq, 'groups': list(groups), 'payload': dict(payload, seq=seq)})
+        return seq
+
+    def last_seq(self, key):
+        return self._last_seq.get(key, 0)
+
+    def since(self, key, seq):
+        with self._lock:
+            last_seq = self._last_seq.get(key, 0)
+            entries = list(self._entries.get(key, ()))
+        if seq > last_seq:
+            return None
+        if seq == last_seq:
+            return []
+        if not entries or seq < entries[0]['seq'] - 1:
+            return None
+        return [entry for entry in entries if entry['seq'] > seq]
+
+
+class CacheChangeLog(BaseChangeLog):
+    """
+    Change log stored in Django's cache so it is shared between workers.
+
+    Use it with a cache backend that is shared between processes, such as
+    memcached, redis or the database cache.
+    """
+
+    def __init__(self, size=None, cache=cache):
+        super(CacheChangeLog, self).__init__(size)
+        self.cache = cache
+
+    def _seq_key(self, key):
+        return 'channels_api:log:{}:seq'.format(key)
+
+    def _entry_key(self, key, seq):
+        return 'channels_api:log:{}:{}'.format(key, seq)
+
+    def append(self, key, groups, payload):
+        seq_key = self._seq_key(key)
+        self.cache.add(seq_key, 0, None)
+        seq = self.cache.incr(seq_key)
+        entry = {'seq': seq, 'groups': list(groups), 'payload': dict(payload, seq=seq)}
+        self.cache.set(self._entry_key(key, seq), entry, None)
+        self.cache.delete(self._entry_key(key, seq - self.size))
+        return seq
+
+    def last_seq(self, key):
+        return self.cache.get(self._seq_key(key), 0)
+
+    def since(self, key, seq):
+        last_seq = self.last_seq(key)
+        if seq > last_seq:
+            return None
+        if seq == last_seq:
+            return []
+        if seq < last_seq - self.size:
+            return None
+        keys = [self._entry_key(key, n) for n in range(seq + 1, last_seq + 1)]
+        found = self.cache.get_many(keys)
+        if len(found) != len(keys):
+            # evicted by the cache
+            return None
+        return [found[k] for k in keys]
+
+
+_change_log = None
+
+
+def get_change_log():
+    """Returns the shared instance of the CHANGE_LOG_CLASS setting."""
+    global _change_log
+    if not isinstance(_change_log, api_settings.CHANGE_LOG_CLASS):
+        _change_log = api_settings.CHANGE_LOG_CLASS()
+    return _change_log
@@ -0,0 +1,115 @@
+import zlib
+
+from channels import Group
+from django.core.cache import cache
+
+from .settings import api_settings
+
+# suffix of the groups that receive compressed messages
+COMPRESSED_GROUP_SUFFIX = '.z'
+# tracking expires like channel layer group memberships
+MEMBERSHIP_TIMEOUT = 86400
+
+
+def _flag_key(reply_channel):
+    return 'channels_api:compress:{}'.format(reply_channel)
+
+
+def _membership_key(reply_channel, group_name):
+    return 'channels_api:group:{}:{}'.format(reply_channel, group_name)
+
+
+def _memberships_count_key(reply_channel):
+    return 'channels_api:groups:{}'.format(reply_channel)
+
+
+def _memberships_slot_key(reply_channel, index):
+    return 'channels_api:groups:{}:{}'.format(reply_channel, index)
+
+
+def compression_available():
+    return api_settings.COMPRESSION_THRESHOLD is not None
+
+
+def compression_enabled(reply_channel):
+    return compression_available() and bool(cache.get(_flag_key(reply_channel)))
+
+
+def compressed_group_name(group_name):
+    return group_name + COMPRESSED_GROUP_SUFFIX
+
+
+def _group_variant(group_name, compressed):
+    return Group(compressed_group_name(group_name) if compressed else group_name)
+
+
+def _record_membership(reply_channel, group_name):
+    # every group gets its own numbered slot once; cache.add and cache.incr are
+    # atomic, so concurrent subscribes from several workers are all recorded
+    if not cache.add(_membership_key(reply_channel, group_name), True, MEMBERSHIP_TIMEOUT):
+        return
+    count_key = _memberships_count_key(reply_channel)
+    cache.add(count_key, 0, MEMBERSHIP_TIMEOUT)
+    index = cache.incr(count_key)
+    cache.set(_memberships_slot_key(reply_channel, index), group_name, MEMBERSHIP_TIMEOUT)
+
+
+def _memberships(reply_channel):
+    count = cache.get(_memberships_count_key(reply_channel), 0)
+    keys = [_memberships_slot_key(reply_channel, index) for index in range(1, count + 1)]
+    return set(cache.get_many(keys).values())
+
+
+def set_compression(reply_channel, enabled):
+    """
+    Records whether a connection accepts compressed binary frames and moves
+    its existing group memberships to the matching group variants.
+    """
+    if enabled:
+        cache.set(_flag_key(reply_channel.name), True, MEMBERSHIP_TIMEOUT)
+    else:
+        cache.delete(_flag_key(reply_channel.name))
+    for group_name in _memberships(reply_channel.name):
+        _group_variant(group_name, not enabled).discard(reply_channel)
+        _group_variant(group_name, enabled).add(reply_channel)
+
+
+def join_group(group_name, reply_channel):
+    """
+    Adds a reply channel to a group, or to its compressed variant if the
+    connection has enabled compression, and leaves the other variant.
+    """
+    if not compression_available():
+        Group(group_name).add(reply_channel)
+        return
+    compressed = compression_enabled(reply_channel.name)
+    _group_variant(group_name, not compressed).discard(reply_channel)
+    _group_variant(group_name, compressed).add(reply_channel)
+    _record_membership(reply_channel.name, group_name)
+
+
+def send_to_groups(group_names, message):
+    """
+    Sends an encoded message to groups and, when compression is available, a
+    copy compressed once to their compressed variants.
+
+    Whether a group has compressed members is not tracked, since a process
+    with its own cache could not see it and would skip them.
+    """
+    group_names = list(group_names)
+    compressed = compress_message(message) if compression_available() and group_names else None
+    for group_name in group_names:
+        Group(group_name).send(message)
+        if compressed is not None:
+            Group(compressed_group_name(group_name)).send(compressed)
+
+
+def compress_message(message):
+    """
+    Returns the zlib compressed binary version of an encoded text message if it
+    is larger than COMPRESSION_THRESHOLD, otherwise the message itself.
+    """
+    text = message['text']
+    if len(text) <= api_settings.COMPRESSION_THRESHOLD:
+        return message
+    return {'bytes': zlib.compress(text.encode('utf-8'))}
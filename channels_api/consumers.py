@@ -0,0 +1,14 @@
+from .bindings import ResourceBindingBase
+
+
+def broadcast(message, **kwargs):
+    """
+    Consumer for the broadcast channel that sends deferred binding messages.
+    """
+    binding = ResourceBindingBase.from_binding_key(message['binding'])
+    if message['type'] == 'change':
+        binding.send_queued_change(message['action'], message['pk'], message['old_group_names'])
+    elif message['type'] == 'pending_update':
+        binding.send_pending_update(message['pk'])
+    elif message['type'] == 'live_aggregates':
+        binding.send_live_aggregates()
@@ -1,10 +1,23 @@
-from channels import Group
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from channels import Channel
+from channels.binding.base import CREATE, UPDATE, DELETE
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core.paginator import Paginator
-from rest_framework.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Avg, Count, F, Max, Min, Sum
+from django.utils import six
 
+from .compression import compression_available, set_compression
 from .decorators import detail_action, list_action
 from .settings import api_settings
 
+logger = logging.getLogger(__name__)
+
 class CreateModelMixin(object):
     """Mixin class that handles the creation of an object using a DRF serializer."""
 
@@ -21,10 +34,47 @@ class CreateModelMixin(object):
 class RetrieveModelMixin(object):
 
     @detail_action()
-    def retrieve(self, pk, **kwargs):
+    def retrieve(self, pk, data=None, **kwargs):
+        if self.use_etags and self.version_field:
+            etag = self.get_object_version_etag(pk)
+            if etag is not None and self.check_etag(data, etag):
+                return None, 304
         instance = self.get_object_or_404(pk)
-        serializer = self.get_serializer(instance)
-        return serializer.data, 200
+        representation = self.get_representation(instance)
+        if self.use_etags and not self.version_field:
+            if self.check_etag(data, self.get_data_etag(representation)):
+                return None, 304
+        return representation, 200
+
+    @list_action()
+    def retrieve_many(self, data, **kwargs):
+        from rest_framework.exceptions import ValidationError
+        pks = (data or {}).get('pks')
+        if not isinstance(pks, list) or not pks:
+            raise ValidationError('pks required')
+        if len(pks) > api_settings.RETRIEVE_MANY_MAX:
+            raise ValidationError('at most {} pks are allowed'.format(api_settings.RETRIEVE_MANY_MAX))
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            # annotate the lookup value, which may span relations (e.g. owner__slug)
+            instances = list(queryset.filter(**{'{}__in'.format(self.lookup_field): pks}).annotate(
+                channels_api_lookup=F(self.lookup_field)))
+        except (TypeError, ValueError, DjangoValidationError):
+            raise ValidationError('invalid pks')
+        found = dict((six.text_type(instance.channels_api_lookup), instance) for instance in instances)
+        # keep the requested order, returning duplicate pks once
+        ordered, missing, seen = [], [], set()
+        for pk in pks:
+            key = six.text_type(pk)
+            if key in seen:
+                continue
+            seen.add(key)
+            instance = found.get(key)
+            if instance is not None:
+                ordered.append(instance)
+            else:
+                missing.append(pk)
+        return {'results': self.get_representation(ordered, many=True), 'missing': missing}, 200
 
 
 class ListModelMixin(object):
@@ -35,9 +85,190 @@ class ListModelMixin(object):
             data = {}
         queryset = self.filter_queryset(self.get_queryset())
         paginator = Paginator(queryset, api_settings.DEFAULT_PAGE_SIZE)
-        data = paginator.page(data.get('page', 1))
-        serializer = self.get_serializer(data, many=True)
-        return serializer.data, 200
+        page = paginator.page(data.get('page', 1))
+        if self.use_etags and self.version_field:
+            etag = self.get_version_etag(page.object_list)
+            if etag is not None and self.check_etag(data, etag):
+                return None, 304
+        representation = self.get_representation(page, many=True)
+        if self.use_etags and not self.version_field:
+            if self.check_etag(data, self.get_data_etag(representation)):
+                return None, 304
+        return representation, 200
+
+
+AGGREGATE_FUNCTIONS = {
+    'count': Count,
+    'sum': Sum,
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+}
+
+
+class AggregateModelMixin(object):
+    """
+    Mixin class that answers counts and aggregates with single database queries.
+
+    Fields have to be whitelisted in `aggregate_fields` ({field: functions})
+    and `group_by_fields`. Aggregates requested with `live` are re-run and
+    sent to the client whenever an instance of the model changes, until
+    nobody has asked for them for LIVE_AGGREGATE_TIMEOUT seconds.
+    """
+
+    aggregate_fields = {}
+    group_by_fields = ()
+    live_aggregates = False
+
+    @list_action()
+    def count(self, data, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return {'count': queryset.count()}, 200
+
+    @list_action()
+    def aggregate(self, data, **kwargs):
+        from rest_framework.exceptions import ValidationError
+        if not data:
+            data = {}
+        if data.get('live') and not self.live_aggregates:
+            raise ValidationError('live aggregates are not supported')
+        spec = self.get_aggregate_spec(data)
+        result = {'aggregates': self.run_aggregate(spec)}
+        if data.get('live'):
+            result['live'] = self.add_live_aggregate(spec)
+            result['timeout'] = api_settings.LIVE_AGGREGATE_TIMEOUT
+        return result, 200
+
+    def get_aggregate_spec(self, data):
+        """Validates the requested aggregates against the whitelists."""
+        from rest_framework.exceptions import ValidationError
+        aggregates = data.get('aggregates')
+        if not aggregates or not isinstance(aggregates, dict):
+            raise ValidationError('aggregates required')
+        for field, functions in aggregates.items():
+            allowed = self.aggregate_fields.get(field, ())
+            if not isinstance(functions, list) or not functions:
+                raise ValidationError('aggregates must map fields to lists of functions')
+            for function in functions:
+                if function not in allowed or function not in AGGREGATE_FUNCTIONS:
+                    raise ValidationError('{} is not allowed on {}'.format(function, field))
+        group_by = data.get('group_by') or []
+        if not isinstance(group_by, list):
+            raise ValidationError('group_by must be a list')
+        for field in group_by:
+            if field not in self.group_by_fields:
+                raise ValidationError('cannot group by {}'.format(field))
+        return {
+            'aggregates': dict((field, sorted(set(functions))) for field, functions in aggregates.items()),
+            'group_by': group_by,
+        }
+
+    def run_aggregate(self, spec):
+        expressions = {}
+        for field, functions in spec['aggregates'].items():
+            for function in functions:
+                alias = '{}__{}'.format(field, function)
+                expressions[alias] = AGGREGATE_FUNCTIONS[function](field)
+        queryset = self.filter_queryset(self.get_queryset())
+        if spec['group_by']:
+            return list(queryset.values(*spec['group_by']).annotate(**expressions).order_by(*spec['group_by']))
+        return queryset.aggregate(**expressions)
+
+    def add_live_aggregate(self, spec):
+        """
+        Joins the reply channel to the group of an aggregate and returns its token.
+
+        Clients asking for the same aggregate share one group, so every spec is
+        only re-run once per change. Each spec is stored in its own cache slot
+        that expires after LIVE_AGGREGATE_TIMEOUT unless a client asks for it
+        again, so specs without subscribers stop being re-run.
+        """
+        from rest_framework.exceptions import ValidationError
+        token = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        entry = {'token': token, 'spec': spec}
+        timeout = api_settings.LIVE_AGGREGATE_TIMEOUT
+        keys = self._live_aggregate_keys()
+        for key in keys:
+            current = cache.get(key)
+            if current is not None and current['token'] == token:
+                cache.set(key, entry, timeout)
+                break
+        else:
+            # cache.add is atomic, so concurrent workers never share a slot
+            for key in keys:
+                if cache.add(key, entry, timeout):
+                    break
+            else:
+                raise ValidationError('too many live aggregates')
+        self.join_group(self._group_name('aggregate', id=token))
+        return token
+
+    @classmethod
+    def _live_aggregate_keys(cls):
+        return ['channels_api:aggregates:{}:{}'.format(cls.binding_key(), n)
+                for n in range(api_settings.LIVE_AGGREGATES_MAX)]
+
+    @classmethod
+    def _pending_aggregates_key(cls):
+        return 'channels_api:pending_aggregates:{}'.format(cls.binding_key())
+
+    @classmethod
+    def send_changes(cls, instance, action, old_group_names, **kwargs):
+        super(AggregateModelMixin, cls).send_changes(instance, action, old_group_names, **kwargs)
+        if cls.live_aggregates:
+            cls.schedule_live_aggregates()
+
+    @classmethod
+    def schedule_live_aggregates(cls):
+        """
+        Asks the broadcast consumer to re-run the live aggregates once the
+        current transaction commits.
+
+        Changes made while a run is pending share it, and with
+        `broadcast_interval` the aggregates run at most once per interval.
+        """
+        def schedule():
+            # the timeout only matters if the message is dropped
+            if not cache.add(cls._pending_aggregates_key(), True, (cls.broadcast_interval or 0) * 2 + 1):
+                return
+            content = {'type': 'live_aggregates', 'binding': cls.binding_key()}
+            if cls.broadcast_interval:
+                Channel('asgi.delay').send({
+                    'channel': api_settings.BROADCAST_CHANNEL,
+                    'delay': int(cls.broadcast_interval * 1000),
+                    'content': content,
+                })
+            else:
+                Channel(api_settings.BROADCAST_CHANNEL).send(content)
+
+        # Django < 1.9 has no on_commit
+        on_commit = getattr(transaction, 'on_commit', None)
+        if on_commit is not None:
+            on_commit(schedule)
+        else:
+            schedule()
+
+    @classmethod
+    def send_live_aggregates(cls):
+        """Re-runs the live aggregates and sends them to their groups."""
+        cache.delete(cls._pending_aggregates_key())
+        entries = cache.get_many(cls._live_aggregate_keys())
+        if not entries:
+            return
+        specs = dict((entry['token'], entry['spec']) for entry in entries.values())
+        self = cls()
+        for token, spec in specs.items():
+            try:
+                aggregates = self.run_aggregate(spec)
+            except Exception:
+                logger.exception('Live aggregate %s of %s failed', token, cls.binding_key())
+                continue
+            payload = {
+                'action': 'aggregate',
+                'data': {'aggregates': aggregates, 'live': token},
+                'model': self.model_label,
+            }
+            cls.send_to_groups([self._group_name('aggregate', id=token)], self.encode(self.stream, payload))
 
 
 class UpdateModelMixin(object):
@@ -81,19 +312,122 @@ class SubscribeModelMixin(object):
 
     @detail_action()
     def subscribe(self, pk, data, **kwargs):
+        from rest_framework.exceptions import ValidationError
 
         if 'action' not in data:
             raise ValidationError('action required')
         action = data['action']
         group_name = self._group_name(action, id=pk)
-        Group(group_name).add(self.message.reply_channel)
-        return {'action': action}, 200
+        self.join_group(group_name)
+        if data.get('since') is None:
+            return {'action': action}, 200
+
+        if not self.change_log:
+            raise ValidationError('since is not supported')
+        try:
+            since = int(data['since'])
+        except (TypeError, ValueError):
+            raise ValidationError('since must be an integer')
+        if since < 0:
+            raise ValidationError('since must not be negative')
+        # changes is None when the client is too far behind and has to list again
+        return {'action': action, 'changes': self.get_changes_since(group_name, since)}, 200
+
+
+class ListSubscribeModelMixin(object):
+
+    @list_action()
+    def list_subscribe(self, data, **kwargs):
+        """
+        Returns a page and subscribes to its changes in one step.
+
+        The reply channel joins the create group and the update/delete groups of
+        the page's rows before the rows are loaded, so no later change is missed.
+        With a change log the reply carries the `seq` read before the rows; the
+        broadcasts with a higher seq may or may not be part of the results, so
+        clients apply them idempotently.
+        """
+        from rest_framework.exceptions import ValidationError
+        if not data:
+            data = {}
+        actions = data.get('actions', [CREATE, UPDATE, DELETE])
+        if not isinstance(actions, list) or not set(actions) <= set([CREATE, UPDATE, DELETE]):
+            raise ValidationError('actions must be a list of create, update or delete')
+
+        if CREATE in actions:
+            self.join_group(self._group_name(CREATE))
+
+        seq = self.get_change_log().last_seq(self.binding_key()) if self.change_log else None
+        queryset = self.filter_queryset(self.get_queryset())
+        paginator = Paginator(queryset, api_settings.DEFAULT_PAGE_SIZE)
+        pks = list(paginator.page(data.get('page', 1)).object_list.values_list('pk', flat=True))
+        for action in actions:
+            if action != CREATE:
+                for group_name in self.detail_group_names(action, pks):
+                    self.join_group(group_name)
+
+        instances = queryset.in_bulk(pks)
+        results = [instances[pk] for pk in pks if pk in instances]
+        return {'results': self.get_representation(results, many=True), 'seq': seq}, 200
+
+
+class CompressionMixin(object):
+
+    @list_action()
+    def set_compression(self, data, **kwargs):
+        """
+        Lets a connection opt in to zlib compressed binary frames for replies
+        and broadcasts larger than COMPRESSION_THRESHOLD.
+
+        Existing subscriptions are moved to receive the chosen format.
+        """
+        from rest_framework.exceptions import ValidationError
+        if not compression_available():
+            raise ValidationError('compression is not supported')
+        enabled = bool((data or {}).get('enabled', True))
+        set_compression(self.message.reply_channel, enabled)
+        return {'enabled': enabled, 'threshold': api_settings.COMPRESSION_THRESHOLD}, 200
+
+
+class CompiledSerializer(object):
+    """
+    Read-only version of a serializer that keeps its bound fields, so instances
+    are turned into dicts without building the field tree again.
+    """
+
+    def __init__(self, serializer):
+        from rest_framework.fields import SkipField
+        from rest_framework.relations import PKOnlyObject
+        self.skip_field = SkipField
+        self.pk_only_object = PKOnlyObject
+        self.fields = [
+            (field.field_name, field.get_attribute, field.to_representation)
+            for field in serializer.fields.values() if not field.write_only
+        ]
+
+    def __call__(self, instance):
+        # mirrors Serializer.to_representation
+        ret = OrderedDict()
+        for field_name, get_attribute, to_representation in self.fields:
+            try:
+                attribute = get_attribute(instance)
+            except self.skip_field:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, self.pk_only_object) else attribute
+            if check_for_none is None:
+                ret[field_name] = None
+            else:
+                ret[field_name] = to_representation(attribute)
+        return ret
 
 
 class SerializerMixin(object):
     """Mixin class that handles the loading of the serializer class, context and object."""
 
     serializer_class = None
+    # use CompiledSerializer for retrieve, list and broadcasts; the serializer
+    # context is captured once, so it must not depend on the message
+    compile_serializers = False
 
     def get_serializer(self, *args, **kwargs):
         serializer_class = self.get_serializer_class()
@@ -112,5 +446,38 @@ class SerializerMixin(object):
         return {
         }
 
+    def get_compiled_serializer(self):
+        """
+        Returns the CompiledSerializer of the serializer class, built once per
+        binding, or None if the serializer customizes `to_representation`.
+        """
+        from rest_framework.serializers import Serializer
+        serializer_class = self.get_serializer_class()
+        cache = self.__class__.__dict__.get('_compiled_serializers')
+        if cache is None:
+            cache = {}
+            self.__class__._compiled_serializers = cache
+        try:
+            return cache[serializer_class]
+        except KeyError:
+            pass
+        to_representation = six.get_unbound_function(serializer_class.to_representation)
+        if to_representation is not six.get_unbound_function(Serializer.to_representation):
+            compiled = None
+        else:
+            compiled = CompiledSerializer(self.get_serializer())
+        cache[serializer_class] = compiled
+        return compiled
+
+    def get_representation(self, instance, many=False):
+        """Serializes instance(s) for read-only use."""
+        if self.compile_serializers:
+            compiled = self.get_compiled_serializer()
+            if compiled is not None:
+                if many:
+                    return [compiled(item) for item in instance]
+                return compiled(instance)
+        return self.get_serializer(instance, many=many).data
+
     def serialize_data(self, instance):
-        return self.get_serializer(instance).data
+        return self.get_representation(instance)
@@ -0,0 +1,8 @@
+from channels.routing import route
+
+from .consumers import broadcast
+from .settings import api_settings
+
+channel_routing = [
+    route(api_settings.BROADCAST_CHANNEL, broadcast)
+]
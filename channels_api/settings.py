@@ -1,15 +1,45 @@
 from django.conf import settings
-
-from rest_framework.settings import APISettings
+from django.core.signals import setting_changed
+from django.utils.functional import LazyObject, empty
 
 DEFAULTS = {
     'DEFAULT_PAGE_SIZE': 25,
+    'RETRIEVE_MANY_MAX': 100,
+    'GROUP_NAME_STYLE': 'label',
+    'BROADCAST_CHANNEL': 'channels_api.broadcast',
+    'CHANGE_LOG_CLASS': 'channels_api.changelog.CacheChangeLog',
+    'CHANGE_LOG_SIZE': 1000,
+    'USER_CACHE_TIMEOUT': 300,
+    'LIVE_AGGREGATE_TIMEOUT': 300,
+    'LIVE_AGGREGATES_MAX': 20,
+    'COMPRESSION_THRESHOLD': None,
     'DEFAULT_PERMISSION_CLASSES': (
         'channels_api.permissions.AllowAny',
     )
 }
 IMPORT_STRINGS = (
     'DEFAULT_PERMISSION_CLASSES',
+    'CHANGE_LOG_CLASS',
 )
 
-api_settings = APISettings(getattr(settings, 'CHANNELS_API', None), DEFAULTS, IMPORT_STRINGS)
+
+class LazyAPISettings(LazyObject):
+    """
+    Builds the settings on first access so importing channels_api does not
+    load rest_framework or configure django settings.
+    """
+
+    def _setup(self):
+        from rest_framework.settings import APISettings
+        self._wrapped = APISettings(getattr(settings, 'CHANNELS_API', None), DEFAULTS, IMPORT_STRINGS)
+
+
+api_settings = LazyAPISettings()
+
+
+def reload_api_settings(*args, **kwargs):
+    if kwargs['setting'] == 'CHANNELS_API':
+        api_settings._wrapped = empty
+
+
+setting_changed.connect(reload_api_settings)
@@ -1,5 +1,6 @@
-from channels import route_class
+from channels import route_class, include
 from channels.generic.websockets import WebsocketDemultiplexer
+from channels_api.auth import CachedUserMixin
 from .test_bindings import TestModelResourceBinding
 
 
@@ -10,6 +11,12 @@ class TestDemultiplexer(WebsocketDemultiplexer):
         'testmodel': TestModelResourceBinding.consumer
     }
 
+
+class CachedUserDemultiplexer(CachedUserMixin, TestDemultiplexer):
+    pass
+
 channel_routing = [
-    route_class(TestDemultiplexer)
+    route_class(CachedUserDemultiplexer, path=r'^/cached/'),
+    route_class(TestDemultiplexer),
+    include('channels_api.routing.channel_routing'),
 ]
\ No newline at end of file
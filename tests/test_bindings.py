@@ -1,10 +1,17 @@
 import json
+import zlib
 try:
     from unittest.mock import Mock, patch
 except ImportError:
     from mock import Mock, patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError as DjangoValidationError
+from django.db import connection
+from django.db.models import AutoField
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.encoding import force_text
 from rest_framework import serializers
 
@@ -12,6 +19,8 @@ from channels.test import WSClient
 from channels.tests import ChannelTestCase, Client
 
 from channels_api import bindings
+from channels_api.auth import get_cached_user, invalidate_cached_user
+from channels_api.changelog import CacheChangeLog, MemoryChangeLog
 from channels_api.decorators import list_action, detail_action
 from channels_api.permissions import IsAuthenticated
 from channels_api.settings import api_settings
@@ -31,6 +40,8 @@ class TestModelResourceBinding(bindings.ResourceBinding):
     queryset = TestModel.objects.all()
     serializer_class = TestModelSerializer
     stream = 'testmodel'
+    aggregate_fields = {'id': ('count', 'max')}
+    group_by_fields = ('name',)
 
     @list_action()
     def test_list(self, data=None, **kwargs):
@@ -41,6 +52,12 @@ class TestModelResourceBinding(bindings.ResourceBinding):
         instance = self.get_object_or_404(pk)
         return instance.name, 200
 
+    @list_action()
+    def count_messages(self, data=None, **kwargs):
+        count = self.message.channel_session.get('count', 0) + 1
+        self.message.channel_session['count'] = count
+        return count, 200
+
     @list_action(name='named_list')
     def some_other_list(self, data=None, **kwargs):
         return 'some data', 200
@@ -56,6 +73,7 @@ class ResourceBindingTestCase(ChannelTestCase):
     def setUp(self):
         super(ResourceBindingTestCase, self).setUp()
         self.client = WSClient()
+        cache.clear()
 
     def _send_and_consume(self, channel, data):
         """Helper that sends and consumes message and returns the next message."""
@@ -454,3 +472,697 @@ class ResourceBindingTestCase(ChannelTestCase):
             json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
 
             self.assertEqual(json_content['payload']['response_status'], 200)
+
+    def test_group_names(self):
+        instance = TestModel.objects.create(name='test-name')
+
+        self.assertEqual(TestModelResourceBinding.group_names(instance, 'update'),
+                         ['tests.testmodel-update', 'tests.testmodel-update-{}'.format(instance.pk)])
+        self.assertEqual(TestModelResourceBinding.detail_group_names('update', [1, 2]),
+                         ['tests.testmodel-update-1', 'tests.testmodel-update-2'])
+
+    def test_hashed_group_names(self):
+        with patch.object(TestModelResourceBinding, 'group_name_style', 'hashed'):
+            name = TestModelResourceBinding._group_name('update', id=1)
+            # it should be compact and stable
+            self.assertEqual(name, TestModelResourceBinding._group_name('update', id=1))
+            self.assertTrue(name.endswith('.u-1'))
+            self.assertLess(len(name), len('tests.testmodel-update-1'))
+
+            # it should keep long pks within the channel layer limit
+            self.assertLess(len(TestModelResourceBinding._group_name('update', id='x' * 200)), 100)
+
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'subscribe',
+                'data': {
+                    'action': 'create'
+                },
+                'request_id': 'client-request-id'
+            }))
+            self.assertEqual(json_content['payload']['response_status'], 200)
+
+            instance = TestModel.objects.create(name='test-name')
+            actual = self._get_next_message()
+            self.assertEqual(actual['payload']['pk'], instance.pk)
+
+    def test_throttled_update(self):
+        instance = TestModel.objects.create(name='test-name')
+
+        with patch.object(TestModelResourceBinding, 'broadcast_interval', 1):
+            self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'subscribe',
+                'pk': instance.pk,
+                'data': {
+                    'action': 'update'
+                },
+                'request_id': 'client-request-id'
+            }))
+
+            for n in range(3):
+                instance.name = 'name-{}'.format(n)
+                instance.save()
+
+            # it should not broadcast right away
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+            # it should schedule a single broadcast
+            delayed = self.get_next_message('asgi.delay', require=True)
+            self.assertIsNone(self.get_next_message('asgi.delay'))
+            self.assertEqual(delayed['delay'], 1000)
+
+            # it should send the latest state when the delay fires
+            self.client.send_and_consume(delayed['channel'], delayed['content'])
+            actual = self._get_next_message()
+            self.assertEqual(actual['payload']['action'], 'update')
+            self.assertEqual(actual['payload']['data']['name'], 'name-2')
+
+            # it should drop the pending update of a deleted object
+            instance.name = 'name-3'
+            instance.save()
+            delayed = self.get_next_message('asgi.delay', require=True)
+            instance.delete()
+            self.client.send_and_consume(delayed['channel'], delayed['content'])
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+    def test_subscribe_since(self):
+        instance = TestModel.objects.create(name='test-name')
+
+        with patch.object(TestModelResourceBinding, 'change_log', True):
+            self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'subscribe',
+                'pk': instance.pk,
+                'data': {
+                    'action': 'update'
+                },
+                'request_id': 'client-request-id'
+            }))
+            instance.name = 'first'
+            instance.save()
+            first = self._get_next_message()['payload']
+            instance.name = 'second'
+            instance.save()
+            TestModel.objects.create(name='other')
+
+            # a reconnecting client only gets the changes it missed
+            self.client = WSClient()
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'subscribe',
+                'pk': instance.pk,
+                'data': {
+                    'action': 'update',
+                    'since': first['seq']
+                },
+                'request_id': 'client-request-id'
+            }))
+
+            changes = json_content['payload']['data']['changes']
+            self.assertEqual(len(changes), 1)
+            self.assertEqual(changes[0]['data']['name'], 'second')
+            self.assertGreater(changes[0]['seq'], first['seq'])
+
+    def test_subscribe_since_negative(self):
+        with patch.object(TestModelResourceBinding, 'change_log', True):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'subscribe',
+                'data': {
+                    'action': 'update',
+                    'since': -1
+                },
+                'request_id': 'client-request-id'
+            }))
+
+        self.assertEqual(json_content['payload']['errors'], ['since must not be negative'])
+
+    def test_subscribe_since_without_change_log(self):
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'subscribe',
+            'data': {
+                'action': 'update',
+                'since': 1
+            },
+            'request_id': 'client-request-id'
+        }))
+
+        self.assertEqual(json_content['payload']['errors'], ['since is not supported'])
+        self.assertEqual(json_content['payload']['response_status'], 400)
+
+    def test_change_logs(self):
+        for change_log in (MemoryChangeLog(size=2), CacheChangeLog(size=2)):
+            key = 'test-{}'.format(id(change_log))
+            self.assertEqual(change_log.since(key, 0), [])
+            for n in range(1, 4):
+                self.assertEqual(change_log.append(key, ['group'], {'n': n}), n)
+
+            self.assertEqual([entry['seq'] for entry in change_log.since(key, 1)], [2, 3])
+            self.assertEqual(change_log.since(key, 3), [])
+            self.assertEqual(change_log.last_seq(key), 3)
+            # it should stamp the stored payloads
+            self.assertEqual(change_log.since(key, 2)[0]['payload'], {'n': 3, 'seq': 3})
+            # it should report discarded entries
+            self.assertIsNone(change_log.since(key, 0))
+            # it should not claim there are no changes for a seq it never issued
+            self.assertIsNone(change_log.since(key, 4))
+            self.assertIsNone(change_log.since('empty-{}'.format(key), 1))
+
+    def test_settings_reload(self):
+        with override_settings(CHANNELS_API={'DEFAULT_PAGE_SIZE': 5}):
+            self.assertEqual(api_settings.DEFAULT_PAGE_SIZE, 5)
+        self.assertEqual(api_settings.DEFAULT_PAGE_SIZE, 25)
+
+    def test_count(self):
+        for n in range(3):
+            TestModel.objects.create(name='Name-{}'.format(n))
+
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'count',
+            'request_id': 'client-request-id'
+        }))
+
+        self.assertEqual(json_content['payload']['data'], {'count': 3})
+
+    def test_aggregate(self):
+        instances = [TestModel.objects.create(name=name) for name in ('a', 'a', 'b')]
+
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'aggregate',
+            'data': {'aggregates': {'id': ['count', 'max']}},
+            'request_id': 'client-request-id'
+        }))
+        self.assertEqual(json_content['payload']['data'], {
+            'aggregates': {'id__count': 3, 'id__max': instances[-1].id}
+        })
+
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'aggregate',
+            'data': {'aggregates': {'id': ['count']}, 'group_by': ['name']},
+            'request_id': 'client-request-id'
+        }))
+        self.assertEqual(json_content['payload']['data'], {
+            'aggregates': [{'name': 'a', 'id__count': 2}, {'name': 'b', 'id__count': 1}]
+        })
+
+    def test_aggregate_not_allowed(self):
+        for data in ({'aggregates': {'id': ['sum']}},
+                     {'aggregates': {'name': ['max']}},
+                     {'aggregates': {'id': ['count']}, 'group_by': ['id']},
+                     {'aggregates': {'id': ['count']}, 'live': True}):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'aggregate',
+                'data': data,
+                'request_id': 'client-request-id'
+            }))
+            self.assertEqual(json_content['payload']['response_status'], 400)
+
+    def test_live_aggregate(self):
+        with patch.object(TestModelResourceBinding, 'live_aggregates', True):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'aggregate',
+                'data': {'aggregates': {'id': ['count']}, 'live': True},
+                'request_id': 'client-request-id'
+            }))
+            token = json_content['payload']['data']['live']
+            self.assertEqual(json_content['payload']['data']['aggregates'], {'id__count': 0})
+
+            with patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                    patch.object(TestModelResourceBinding, 'run_aggregate') as mock_run_aggregate:
+                TestModel.objects.create(name='test-name')
+                TestModel.objects.create(name='test-name')
+            # it should not run the aggregates while saving
+            self.assertFalse(mock_run_aggregate.called)
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+            # both changes share one run
+            event = self.get_next_message(api_settings.BROADCAST_CHANNEL, require=True)
+            self.assertIsNone(self.get_next_message(api_settings.BROADCAST_CHANNEL))
+            self.client.send_and_consume(api_settings.BROADCAST_CHANNEL, event.content)
+
+            expected = {
+                'action': 'aggregate',
+                'data': {'aggregates': {'id__count': 2}, 'live': token},
+                'model': 'tests.testmodel'
+            }
+            self.assertEqual(self._get_next_message()['payload'], expected)
+
+    def test_live_aggregate_failure(self):
+        with patch.object(TestModelResourceBinding, 'live_aggregates', True):
+            self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'aggregate',
+                'data': {'aggregates': {'id': ['count']}, 'live': True},
+                'request_id': 'client-request-id'
+            }))
+
+            # e.g. a filter_queryset that needs the user
+            with patch.object(TestModelResourceBinding, 'run_aggregate', side_effect=AttributeError('user')), \
+                    patch('channels_api.mixins.logger') as mock_logger:
+                TestModelResourceBinding.send_live_aggregates()
+            # it should log the failure and skip the aggregate
+            self.assertTrue(mock_logger.exception.called)
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+    @override_settings(CHANNELS_API={'LIVE_AGGREGATES_MAX': 1})
+    def test_live_aggregate_expiry(self):
+        keys = TestModelResourceBinding._live_aggregate_keys()
+        message = {
+            'action': 'aggregate',
+            'data': {'aggregates': {'id': ['count']}, 'live': True},
+            'request_id': 'client-request-id'
+        }
+
+        with patch.object(TestModelResourceBinding, 'live_aggregates', True):
+            # asking again should refresh the same spec
+            for n in range(2):
+                json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', message))
+                self.assertEqual(json_content['payload']['data']['timeout'], api_settings.LIVE_AGGREGATE_TIMEOUT)
+
+            # it should limit the number of different live aggregates
+            other = dict(message, data={'aggregates': {'id': ['max']}, 'live': True})
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', other))
+            self.assertEqual(json_content['payload']['errors'], ['too many live aggregates'])
+
+            # it should stop re-running expired specs
+            cache.delete_many(keys)
+            with patch.object(TestModelResourceBinding, 'run_aggregate') as mock_run_aggregate:
+                TestModelResourceBinding.send_live_aggregates()
+            self.assertFalse(mock_run_aggregate.called)
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+    def test_retrieve_not_modified(self):
+        instance = TestModel.objects.create(name='Test')
+        content = {
+            'action': 'retrieve',
+            'pk': instance.id,
+            'request_id': 'client-request-id'
+        }
+
+        with patch.object(TestModelResourceBinding, 'use_etags', True):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
+            etag = json_content['payload']['etag']
+            self.assertEqual(json_content['payload']['data'], TestModelSerializer(instance).data)
+
+            content['data'] = {'if_none_match': etag}
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
+            expected = {
+                'action': 'retrieve',
+                'data': None,
+                'errors': [],
+                'etag': etag,
+                'response_status': 304,
+                'request_id': 'client-request-id'
+            }
+            self.assertEqual(json_content['payload'], expected)
+
+            # it should send the data again after a change
+            instance.name = 'Changed'
+            instance.save()
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
+            self.assertEqual(json_content['payload']['response_status'], 200)
+            self.assertNotEqual(json_content['payload']['etag'], etag)
+
+    def test_retrieve_by_version_invalid_pk_404(self):
+        with patch.object(TestModelResourceBinding, 'use_etags', True), \
+                patch.object(TestModelResourceBinding, 'version_field', 'name'):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve',
+                'pk': 'invalid-pk-value',
+                'request_id': 'client-request-id'
+            }))
+        self.assertEqual(json_content['payload']['errors'], ['Not found.'])
+        self.assertEqual(json_content['payload']['response_status'], 404)
+
+    def test_retrieve_by_invalid_version_field(self):
+        instance = TestModel.objects.create(name='Test')
+        with patch.object(TestModelResourceBinding, 'use_etags', True), \
+                patch.object(TestModelResourceBinding, 'version_field', 'missing_field'):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve',
+                'pk': instance.id,
+                'request_id': 'client-request-id'
+            }))
+        # it should fall back to a reply without etag
+        self.assertEqual(json_content['payload']['response_status'], 200)
+        self.assertNotIn('etag', json_content['payload'])
+
+    def test_list_not_modified_by_version(self):
+        for n in range(3):
+            TestModel.objects.create(name='Name-{}'.format(n))
+        content = {
+            'action': 'list',
+            'request_id': 'client-request-id',
+            'data': None
+        }
+
+        with patch.object(TestModelResourceBinding, 'use_etags', True), \
+                patch.object(TestModelResourceBinding, 'version_field', 'name'):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
+            self.assertEqual(len(json_content['payload']['data']), 3)
+
+            content['data'] = {'if_none_match': json_content['payload']['etag']}
+            mock_get_serializer = Mock()
+            with patch.object(TestModelResourceBinding, 'get_serializer', mock_get_serializer):
+                json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', content))
+
+            # it should not serialize anything
+            self.assertEqual(json_content['payload']['response_status'], 304)
+            self.assertFalse(mock_get_serializer.called)
+
+    def test_cached_user(self):
+        user = User.objects.create(username="testuser", password="123")
+        self.client.force_login(user)
+        self.client._session_cookie = True
+        content = self._build_message('testmodel', {
+            'action': 'test_list',
+            'pk': None,
+            'data': {},
+            'request_id': 'client-request-id',
+        })
+        content['path'] = '/cached/'
+
+        def auth_queries(content):
+            with CaptureQueriesContext(connection) as queries:
+                json_content = self._send_and_consume('websocket.receive', content)
+            self.assertEqual(json_content['payload']['response_status'], 200)
+            return [query['sql'] for query in queries.captured_queries
+                    if 'django_session' in query['sql'] or 'auth_user' in query['sql']]
+
+        with patch.object(TestModelResourceBinding, 'permission_classes', (IsAuthenticated,)), \
+                patch.object(TestModelResourceBinding, 'cache_user', True), \
+                patch('channels_api.auth.cache_is_shared', return_value=True):
+            # the user is resolved on connect
+            self.client.send_and_consume('websocket.connect', {'path': '/cached/'})
+            self.assertEqual(auth_queries(content), [])
+            self.assertEqual(auth_queries(content), [])
+
+            # actions can still use the channel session
+            count_content = self._build_message('testmodel', {
+                'action': 'count_messages',
+                'pk': None,
+                'data': {},
+                'request_id': 'client-request-id',
+            })
+            count_content['path'] = '/cached/'
+            for n in range(1, 3):
+                json_content = self._send_and_consume('websocket.receive', count_content)
+                self.assertEqual(json_content['payload']['data'], n)
+
+            # it should load the user again after invalidation
+            invalidate_cached_user(user)
+            self.assertNotEqual(auth_queries(content), [])
+            self.assertEqual(auth_queries(content), [])
+
+    def test_cached_user_binding(self):
+        user = User.objects.create(username="testuser", password="123")
+        self.client.force_login(user)
+        self.client._session_cookie = True
+        content = self._build_message('testmodel', {
+            'action': 'count_messages',
+            'pk': None,
+            'data': {},
+            'request_id': 'client-request-id',
+        })
+
+        with patch.object(TestModelResourceBinding, 'permission_classes', (IsAuthenticated,)), \
+                patch.object(TestModelResourceBinding, 'cache_user', True), \
+                patch('channels_api.auth.cache_is_shared', return_value=True):
+            for n in range(1, 4):
+                json_content = self._send_and_consume('websocket.receive', content)
+                self.assertEqual(json_content['payload']['data'], n)
+                self.assertEqual(get_cached_user(self.client.reply_channel), user)
+
+            # it should drop the user when it is saved, e.g. after a password change
+            user.set_password('changed')
+            user.save()
+            json_content = self._send_and_consume('websocket.receive', content)
+            self.assertEqual(json_content['payload']['response_status'], 401)
+
+    def test_cached_user_needs_shared_cache(self):
+        content = self._build_message('testmodel', {
+            'action': 'test_list',
+            'pk': None,
+            'data': {},
+            'request_id': 'client-request-id',
+        })
+
+        # the test settings use the per-process LocMemCache
+        with patch.object(TestModelResourceBinding, 'cache_user', True):
+            with self.assertRaises(ImproperlyConfigured):
+                self.client.send_and_consume('websocket.receive', content)
+        content['path'] = '/cached/'
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.send_and_consume('websocket.receive', content)
+
+    def test_compiled_serializer(self):
+        instances = [TestModel.objects.create(name='Name-{}'.format(n)) for n in range(3)]
+        expected = [dict(data) for data in TestModelSerializer(instances, many=True).data]
+
+        with patch.object(TestModelResourceBinding, 'compile_serializers', True), \
+                patch.object(TestModelSerializer, 'get_fields', autospec=True,
+                             side_effect=TestModelSerializer.get_fields) as mock_get_fields:
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'list',
+                'request_id': 'client-request-id',
+                'data': None,
+            }))
+            self.assertEqual(json_content['payload']['data'], expected)
+            mock_get_fields.reset_mock()
+
+            for instance, data in zip(instances, expected):
+                json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                    'action': 'retrieve',
+                    'pk': instance.id,
+                    'request_id': 'client-request-id'
+                }))
+                self.assertEqual(json_content['payload']['data'], data)
+                # broadcasts use it as well
+                instance.save()
+
+            # it should not build the fields again
+            self.assertFalse(mock_get_fields.called)
+
+    def test_background_broadcasts(self):
+        self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'subscribe',
+            'data': {
+                'action': 'create'
+            },
+            'request_id': 'client-request-id'
+        }))
+
+        with patch.object(TestModelResourceBinding, 'background_broadcasts', True), \
+                patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            with patch.object(TestModelResourceBinding, 'serialize', autospec=True,
+                              side_effect=TestModelResourceBinding.serialize) as mock_serialize:
+                instance = TestModel.objects.create(name='test-name')
+            # it should not serialize while saving
+            self.assertFalse(mock_serialize.called)
+            self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+            event = self.get_next_message(api_settings.BROADCAST_CHANNEL, require=True)
+            self.assertEqual(event['action'], 'create')
+            self.assertEqual(event['old_group_names'], [])
+
+            self.client.send_and_consume(api_settings.BROADCAST_CHANNEL, event.content)
+
+        expected = {
+            'action': 'create',
+            'data': TestModelSerializer(instance).data,
+            'model': 'tests.testmodel',
+            'pk': instance.id
+        }
+        self.assertEqual(self._get_next_message()['payload'], expected)
+
+    def test_retrieve_many(self):
+        instances = [TestModel.objects.create(name='Name-{}'.format(n)) for n in range(3)]
+
+        with CaptureQueriesContext(connection) as queries:
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve_many',
+                'data': {'pks': [instances[2].id, -1, instances[0].id]},
+                'request_id': 'client-request-id'
+            }))
+        # it should fetch all objects with a single query
+        self.assertEqual(len([query for query in queries if 'tests_testmodel' in query['sql']]), 1)
+
+        expected = {
+            'action': 'retrieve_many',
+            'data': {
+                'results': [TestModelSerializer(instances[2]).data, TestModelSerializer(instances[0]).data],
+                'missing': [-1]
+            },
+            'errors': [],
+            'response_status': 200,
+            'request_id': 'client-request-id'
+        }
+        self.assertEqual(json_content['payload'], expected)
+
+    def test_retrieve_many_duplicates(self):
+        instance = TestModel.objects.create(name='Name')
+
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'retrieve_many',
+            'data': {'pks': [instance.id, instance.id, -1, -1]},
+            'request_id': 'client-request-id'
+        }))
+
+        self.assertEqual(json_content['payload']['data'], {
+            'results': [TestModelSerializer(instance).data],
+            'missing': [-1]
+        })
+
+    def test_retrieve_many_failure(self):
+        too_many = list(range(api_settings.RETRIEVE_MANY_MAX + 1))
+        for data in ({}, {'pks': too_many}, {'pks': ['invalid-pk-value']}):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve_many',
+                'data': data,
+                'request_id': 'client-request-id'
+            }))
+            self.assertEqual(json_content['payload']['response_status'], 400)
+
+        # e.g. UUID pks reject malformed values with a ValidationError
+        with patch.object(AutoField, 'get_prep_value', side_effect=DjangoValidationError('invalid')):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve_many',
+                'data': {'pks': ['invalid-pk-value']},
+                'request_id': 'client-request-id'
+            }))
+        self.assertEqual(json_content['payload']['response_status'], 400)
+
+    def test_retrieve_many_by_lookup_field(self):
+        instances = [TestModel.objects.create(name='Name-{}'.format(n)) for n in range(2)]
+
+        with patch.object(TestModelResourceBinding, 'lookup_field', 'name'):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'retrieve_many',
+                'data': {'pks': ['Name-1', 'missing', 'Name-0']},
+                'request_id': 'client-request-id'
+            }))
+
+        self.assertEqual(json_content['payload']['data'], {
+            'results': [TestModelSerializer(instances[1]).data, TestModelSerializer(instances[0]).data],
+            'missing': ['missing']
+        })
+
+    def test_list_subscribe(self):
+        instances = [TestModel.objects.create(name='Name-{}'.format(n)) for n in range(3)]
+
+        with patch.object(TestModelResourceBinding, 'change_log', True):
+            json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+                'action': 'list_subscribe',
+                'data': None,
+                'request_id': 'client-request-id'
+            }))
+            data = json_content['payload']['data']
+            self.assertEqual(data['results'], [dict(TestModelSerializer(instance).data) for instance in instances])
+
+            # it should be subscribed to the rows of the page
+            instances[0].name = 'changed'
+            instances[0].save()
+            update = self._get_next_message()['payload']
+            self.assertEqual(update['action'], 'update')
+            self.assertEqual(update['pk'], instances[0].id)
+            # broadcasts after the snapshot have a higher seq
+            self.assertGreater(update['seq'], data['seq'])
+
+            # it should be subscribed to creates
+            instance = TestModel.objects.create(name='new')
+            self.assertEqual(self._get_next_message()['payload']['pk'], instance.id)
+
+    def test_list_subscribe_failure(self):
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'list_subscribe',
+            'data': {'actions': ['retrieve']},
+            'request_id': 'client-request-id'
+        }))
+        self.assertEqual(json_content['payload']['response_status'], 400)
+
+    def _get_next_compressed_message(self):
+        msg = self.client.get_next_message(self.client.reply_channel)
+        return json.loads(zlib.decompress(msg['bytes']).decode('utf-8'))
+
+    def test_compression_not_supported(self):
+        json_content = self._send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'set_compression',
+            'data': {'enabled': True},
+            'request_id': 'client-request-id'
+        }))
+        self.assertEqual(json_content['payload']['errors'], ['compression is not supported'])
+
+    @override_settings(CHANNELS_API={'COMPRESSION_THRESHOLD': 300})
+    def test_compression(self):
+        instance = TestModel.objects.create(name='x' * 500)
+        retrieve = self._build_message('testmodel', {
+            'action': 'retrieve',
+            'pk': instance.id,
+            'request_id': 'client-request-id'
+        })
+
+        # it should not compress for connections that did not ask for it
+        self.assertEqual(self._send_and_consume('websocket.receive', retrieve)['payload']['response_status'], 200)
+
+        self.client.send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'set_compression',
+            'data': {'enabled': True},
+            'request_id': 'client-request-id'
+        }))
+        # small replies stay text
+        self.assertEqual(self._get_next_message()['payload']['data'], {'enabled': True, 'threshold': 300})
+
+        self.client.send_and_consume('websocket.receive', retrieve)
+        payload = self._get_next_compressed_message()['payload']
+        self.assertEqual(payload['data'], TestModelSerializer(instance).data)
+
+        self.client.send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'subscribe',
+            'pk': instance.id,
+            'data': {'action': 'update'},
+            'request_id': 'client-request-id'
+        }))
+        self._get_next_message()
+
+        instance.name = 'y' * 500
+        instance.save()
+        payload = self._get_next_compressed_message()['payload']
+        self.assertEqual(payload['data']['name'], 'y' * 500)
+
+    def _set_compression(self, enabled):
+        self.client.send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'set_compression',
+            'data': {'enabled': enabled},
+            'request_id': 'client-request-id'
+        }))
+        self._get_next_message()
+
+    def _subscribe_update(self, pk):
+        self.client.send_and_consume('websocket.receive', self._build_message('testmodel', {
+            'action': 'subscribe',
+            'pk': pk,
+            'data': {'action': 'update'},
+            'request_id': 'client-request-id'
+        }))
+        self._get_next_message()
+
+    @override_settings(CHANNELS_API={'COMPRESSION_THRESHOLD': 300})
+    def test_compression_memberships(self):
+        instance = TestModel.objects.create(name='x' * 500)
+        self._subscribe_update(instance.id)
+        instance.save()
+        self._get_next_message()
+
+        # it should move existing subscriptions and not duplicate them
+        self._set_compression(True)
+        self._subscribe_update(instance.id)
+        instance.save()
+        self.assertEqual(self._get_next_compressed_message()['payload']['pk'], instance.id)
+        self.assertIsNone(self.client.get_next_message(self.client.reply_channel))
+
+        # a process that does not share the cache still reaches compressed members
+        with patch('channels_api.compression.cache.get_many', return_value={}), \
+                patch('channels_api.compression.cache.get', return_value=None):
+            instance.save()
+        self.assertEqual(self._get_next_compressed_message()['payload']['pk'], instance.id)
+
+        # it should move them back when compression is disabled
+        self._set_compression(False)
+        instance.save()
+        self.assertEqual(self._get_next_message()['payload']['pk'], instance.id)
+        self.assertIsNone(self.client.get_next_message(self.client.reply_channel))